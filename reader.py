@@ -4,7 +4,7 @@ import openai
 import pytesseract
 import cv2
 import re
-from PIL import Image, ImageTk
+from PIL import Image, ImageOps, ImageTk
 import dateutil.parser as date_parser
 from datetime import datetime
 from unidecode import unidecode
@@ -16,7 +16,7 @@ from oauth2client.service_account import ServiceAccountCredentials
 
 
 class Ticket():
-    def __init__(self, ticket_image, file_name, sheet=None, gpt=False) -> None:
+    def __init__(self, ticket_image, file_name, sheet=None, gpt=False, source_file_name=None, region=None) -> None:
         
         """
         Initialize a Ticket object.
@@ -26,12 +26,16 @@ class Ticket():
             file_name (str): Name of the ticket file.
             sheet (object): Optional sheet object for storing ticket information.
             gpt (bool): Flag indicating whether to use GPT for information extraction.
+            source_file_name (str): Name of the photo the ticket comes from, defaults to file_name.
+            region (tuple): Optional (x, y, width, height) box of the ticket in the source photo.
         """
 
         Ticket.system_prompt = """Tu sais lire les tickets de caisse. On te donnera toujours ce qui a été lu sur un ticket de caisse. Ton but sera de récupérer 3 informations sur ce ticket, le montant total, la date de l’achat, et le libellé de l’achat, c’est à dire le magasin dans lequel a été effectué la dépense ou la raison de la dépense (il faut que le libellé soit court mais explicite). Ajoute CB au début du libellé si le paiement a été effectué en carte bancaire. Tu présenteras ta recherche en renvoyant uniquement un dictionnaire de la forme suivante : {"libelle" : "" , "date" : "jj/mm/aaaa", "montant" : "nombre"}
         le montant doit être une chaine de caractère contenant un nombre. De plus, si tu ne trouves pas l’une des 3 valeurs, alors met None."""
         self.ticket_image = ticket_image
         self.file_name = file_name
+        self.source_file_name = source_file_name if source_file_name else file_name
+        self.region = region
         self.reading_status = True
         self.sheet = sheet
         self.text_recognition = pytesseract.image_to_string(self.ticket_image, lang="fra")
@@ -240,21 +244,117 @@ class Ticket():
         else:
             self.reading_status = False
     
+    @staticmethod
+    def segment_image(image_path, max_side=1000, min_area_ratio=0.02, max_gap_ratio=0.05, max_span_shift=0.1, min_relative_area=0.3, min_aspect_ratio=1.2):
+
+        """
+        Find the separate tickets photographed in a single image.
+
+        Args:
+            image_path (str): Path to the photo.
+            max_side (int): Size of the longest side of the downscaled frame used for the detection.
+            min_area_ratio (float): Minimum area of a region, relative to the photo, to be considered at all.
+            max_gap_ratio (float): Maximum vertical gap, relative to the photo height, between two pieces of a same ticket.
+            max_span_shift (float): Maximum shift of the left and right edges, relative to the width, between two pieces of a same ticket.
+            min_relative_area (float): Minimum area of a ticket, relative to the largest region found.
+            min_aspect_ratio (float): Minimum height / width ratio of a ticket.
+
+        Returns:
+            list: (region, image) tuples, region being the (x, y, width, height) box of the ticket
+                  in the photo and image its grayscale crop. Region is None when the photo holds a single ticket,
+                  or when its regions do not clearly look like separate tickets.
+                  The list is empty when the file cannot be decoded as an image.
+        """
+
+        # Charger l'image en niveaux de gris une seule fois, les découpes partagent ce décodage
+        image = cv2.imread(str(image_path), cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            # Fichier illisible (.DS_Store par exemple) : aucun ticket
+            return []
+        height, width = image.shape[:2]
+
+        # Travailler sur une version réduite de l'image pour que la détection reste rapide
+        scale = min(1.0, max_side / max(height, width))
+        small_image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+        # Les tickets sont plus clairs que le fond : on isole le papier puis on referme les trous laissés par le texte
+        blurred_image = cv2.GaussianBlur(small_image, (5, 5), 0)
+        _, mask = cv2.threshold(blurred_image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (15, 15))
+        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+
+        # Chaque contour extérieur suffisamment grand est une partie de ticket potentielle
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        min_area = min_area_ratio * small_image.shape[0] * small_image.shape[1]
+        boxes = [cv2.boundingRect(contour) for contour in contours if cv2.contourArea(contour) >= min_area]
+
+        # Recoller les morceaux d'un ticket coupé par un pli ou une ombre : même largeur, même position et faible écart vertical
+        max_gap = max_gap_ratio * small_image.shape[0]
+        has_merged = False
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(boxes)):
+                for j in range(i + 1, len(boxes)):
+                    ax, ay, aw, ah = boxes[i]
+                    bx, by, bw, bh = boxes[j]
+                    max_shift = max_span_shift * max(aw, bw)
+                    same_span = abs(ax - bx) <= max_shift and abs((ax + aw) - (bx + bw)) <= max_shift
+                    y_gap = max(ay, by) - min(ay + ah, by + bh)
+                    if same_span and y_gap <= max_gap:
+                        x0, y0 = min(ax, bx), min(ay, by)
+                        x1, y1 = max(ax + aw, bx + bw), max(ay + ah, by + bh)
+                        boxes[i] = (x0, y0, x1 - x0, y1 - y0)
+                        boxes.pop(j)
+                        merged = True
+                        has_merged = True
+                        break
+                if merged:
+                    break
+
+        # Un seul ticket, ou des régions qui ne ressemblent pas à des tickets séparés : on garde l'image entière.
+        # C'est le cas dès qu'une région est bien plus petite que les autres (petit ticket ou objet, qu'on ne doit pas perdre),
+        # qu'une région n'a pas la forme allongée d'un ticket, ou que des morceaux ont été recollés alors qu'il reste
+        # plusieurs régions (impossible de distinguer un pli de deux tickets posés l'un au-dessus de l'autre).
+        if len(boxes) < 2 or has_merged:
+            return [(None, image)]
+        largest_area = max(w * h for _, _, w, h in boxes)
+        if any(w * h < min_relative_area * largest_area or h < min_aspect_ratio * w for _, _, w, h in boxes):
+            return [(None, image)]
+
+        # Ordonner les tickets par rangée de haut en bas, puis de gauche à droite dans chaque rangée
+        rows = []
+        for box in sorted(boxes, key=lambda box: box[1]):
+            if rows and box[1] < rows[-1][0][1] + rows[-1][0][3] / 2:
+                rows[-1].append(box)
+            else:
+                rows.append([box])
+
+        # Revenir à la résolution d'origine pour découper les tickets
+        regions = []
+        for x, y, w, h in [box for row in rows for box in sorted(row)]:
+            x0, y0 = int(x / scale), int(y / scale)
+            x1, y1 = min(width, int((x + w) / scale)), min(height, int((y + h) / scale))
+            regions.append(((x0, y0, x1 - x0, y1 - y0), image[y0:y1, x0:x1]))
+        return regions
+
     @staticmethod   
-    def preprocess_image(image_path):
+    def preprocess_image(image_path=None, image=None):
 
         """
         Preprocess the ticket image.
 
         Args:
-            image_path (str): Path to the ticket image.
+            image_path (str): Path to the ticket image, used when image is not given.
+            image (ndarray): Optional grayscale image already decoded, e.g. a region from segment_image.
 
         Returns:
             Image: Processed image in the form of a PIL Image.
         """
 
-        # Charger l'image en niveaux de gris
-        image = cv2.imread(str(image_path), cv2.IMREAD_GRAYSCALE)
+        # Charger l'image en niveaux de gris si elle n'a pas déjà été décodée
+        if image is None:
+            image = cv2.imread(str(image_path), cv2.IMREAD_GRAYSCALE)
 
         # Appliquer un seuillage adaptatif pour binariser l'image
         _, threshold_image = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
@@ -336,13 +436,13 @@ class TicketReader():
                                             text="Sélectionner photos tickets",
                                             command=self.add_ticket_photos)
 
-        self.ticket_count = len(list(ticket_directory.iterdir()))
+        self.photo_count = len(list(ticket_directory.iterdir()))
         self.information_ajout = tk.StringVar()
         self.information_ajout_label = tk.Label(self.root, textvariable=self.information_ajout)
-        if self.ticket_count == 0:
-            self.information_ajout.set(value="Aucun ticket sélectionné")
+        if self.photo_count == 0:
+            self.information_ajout.set(value="Aucune photo sélectionnée")
         else:
-            self.information_ajout.set(value=f"{self.ticket_count} tickets sélectionnés")
+            self.information_ajout.set(value=f"{self.photo_count} photos sélectionnées")
 
         self.button_upload_ticket = tk.Button(self.root, text="Ajouter tickets", command=self.upload_ticket)
 
@@ -374,8 +474,8 @@ class TicketReader():
                 destination_file = self.ticket_directory / Path(path).name
                 if not destination_file.exists():
                     destination_file.write_bytes(Path(path).read_bytes())
-                    self.ticket_count += 1
-        self.information_ajout.set(value=f"{self.ticket_count} tickets sélectionnés")
+                    self.photo_count += 1
+        self.information_ajout.set(value=f"{self.photo_count} photos sélectionnées")
     
     def upload_ticket(self):
 
@@ -392,8 +492,9 @@ class TicketReader():
                 self.label_error.destroy()
                 self.label_error = None
 
-            # Création des objets tickets
+            # Création des objets tickets, une photo pouvant contenir plusieurs tickets
             self.create_tickets()
+            self.information_ajout.set(value=f"{len(self.tickets)} tickets détectés sur {self.photo_count} photos")
 
             # Vérifier que tout les tickets sont bons
             ready_to_upload = True
@@ -427,18 +528,24 @@ class TicketReader():
         """
         Create Ticket objects for each file in the ticket directory.
 
-        This method creates Ticket objects for each file in the ticket directory and adds them to the list.
+        This method creates Ticket objects for each ticket found in the files of the ticket directory and adds them to the list.
+        A photo holding several tickets gives one Ticket object per ticket.
         """
 
         for file in self.ticket_directory.iterdir():
             if file.is_file():
-                if file.name not in [ticket.file_name for ticket in self.tickets]:
-                    ticket_image = Ticket.preprocess_image(image_path=file)
-                    ticket = Ticket(ticket_image=ticket_image, 
-                                    file_name=file.name, 
-                                    sheet=self.sheets[self.selected_sheet.get()],
-                                    gpt=self.use_gpt)
-                    self.tickets.append(ticket)
+                if file.name not in [ticket.source_file_name for ticket in self.tickets]:
+                    regions = Ticket.segment_image(image_path=file)
+                    for index, (region, image) in enumerate(regions):
+                        ticket_image = Ticket.preprocess_image(image=image)
+                        file_name = file.name if region is None else f"{file.name} #{index + 1}"
+                        ticket = Ticket(ticket_image=ticket_image, 
+                                        file_name=file_name, 
+                                        sheet=self.sheets[self.selected_sheet.get()],
+                                        gpt=self.use_gpt,
+                                        source_file_name=file.name,
+                                        region=region)
+                        self.tickets.append(ticket)
                 
     def destroy_label_error(self, event):
 
@@ -532,6 +639,24 @@ class TicketReader():
             if ticket.file_name == filename:
                 return ticket
 
+    def get_ticket_image(self, ticket):
+
+        """
+        Get the image of a ticket, cropped from its source photo when the photo holds several tickets.
+
+        Args:
+            ticket (Ticket): Ticket to display.
+
+        Returns:
+            Image: Image of the ticket in the form of a PIL Image.
+        """
+
+        ticket_image = ImageOps.exif_transpose(Image.open(self.ticket_directory / ticket.source_file_name))
+        if ticket.region:
+            x, y, w, h = ticket.region
+            ticket_image = ticket_image.crop((x, y, x + w, y + h))
+        return ticket_image
+
     def open_ticket_page(self):
 
         """
@@ -546,7 +671,7 @@ class TicketReader():
         self.ticket_page.protocol("WM_DELETE_WINDOW", self.close_ticket_page)
 
         # Obtenir l’image à la bonne taille 
-        ticket_image = Image.open(self.ticket_directory / self.selected_ticket.file_name)
+        ticket_image = self.get_ticket_image(ticket=self.selected_ticket)
         resized_ticket_image = ticket_image.resize((500, 800))
         self.selected_ticket_image = ImageTk.PhotoImage(resized_ticket_image)
         self.label_ticket_image = tk.Label(self.ticket_page, image=self.selected_ticket_image)
@@ -657,8 +782,8 @@ class TicketReader():
         for file in self.ticket_directory.iterdir():
             if file.is_file():
                 file.unlink()
-        self.ticket_count = 0 
-        self.information_ajout.set(value="Aucun ticket sélectionné")
+        self.photo_count = 0 
+        self.information_ajout.set(value="Aucune photo sélectionnée")
         self.tickets = []
         self.failing_tickets = []
         self.success_tickets = []
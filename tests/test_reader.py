@@ -0,0 +1,153 @@
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+
+import reader
+from reader import Ticket, TicketReader
+
+
+def draw_receipt(image, x, y, width, height):
+
+    """
+    Draw a bright receipt with dark text lines on a synthetic photo.
+    """
+
+    image[y:y + height, x:x + width] = 230
+    for line_y in range(y + 40, y + height - 40, 35):
+        image[line_y:line_y + 12, x + 30:x + width - 60] = 30
+
+
+def write_photo(path, size, receipts):
+
+    """
+    Write a synthetic photo of the given size holding the given receipts.
+    """
+
+    image = np.full(size, 50, dtype=np.uint8)
+    for receipt in receipts:
+        draw_receipt(image, *receipt)
+    cv2.imwrite(str(path), image)
+    return image
+
+
+def segment(path):
+
+    """
+    Return the regions found by Ticket.segment_image.
+    """
+
+    return [region for region, _ in Ticket.segment_image(image_path=path)]
+
+
+def test_single_receipt_keeps_whole_image(tmp_path):
+    path = tmp_path / "single.png"
+    image = write_photo(path, (2000, 1000), [(100, 100, 800, 1800)])
+    regions = Ticket.segment_image(image_path=path)
+    assert len(regions) == 1
+    assert regions[0][0] is None
+    assert np.array_equal(regions[0][1], image)
+
+
+def test_folded_receipt_is_one_ticket(tmp_path):
+    path = tmp_path / "fold.png"
+    image = np.full((2000, 1000), 50, dtype=np.uint8)
+    draw_receipt(image, 100, 100, 800, 1800)
+    image[990:1030, 100:900] = 50
+    cv2.imwrite(str(path), image)
+    assert segment(path) == [None]
+
+
+def test_receipt_next_to_small_object_is_one_ticket(tmp_path):
+    path = tmp_path / "object.png"
+    image = write_photo(path, (2000, 1600), [(100, 100, 800, 1800)])
+    image[200:600, 1100:1400] = 230
+    cv2.imwrite(str(path), image)
+    assert segment(path) == [None]
+
+
+def test_mixed_receipt_sizes_keep_whole_image(tmp_path):
+    path = tmp_path / "mixed.png"
+    write_photo(path, (2000, 2600), [(100, 100, 700, 1800), (950, 100, 700, 1800), (1800, 100, 600, 500)])
+    assert segment(path) == [None]
+
+
+def test_receipts_side_by_side_are_split_left_to_right(tmp_path):
+    path = tmp_path / "side_by_side.png"
+    write_photo(path, (2000, 2600), [(100, 100, 700, 1700), (950, 100, 700, 1700), (1800, 100, 700, 1700)])
+    regions = segment(path)
+    assert len(regions) == 3
+    assert [region[0] for region in regions] == sorted(region[0] for region in regions)
+
+
+def test_receipts_in_rows_are_read_row_by_row(tmp_path):
+    path = tmp_path / "rows.png"
+    write_photo(path, (2400, 1800), [(150, 100, 600, 1000), (1000, 100, 600, 1000),
+                                     (100, 1300, 600, 1000), (1000, 1300, 600, 1000)])
+    regions = segment(path)
+    assert len(regions) == 4
+    assert regions[0][1] < 1000 and regions[1][1] < 1000 and regions[0][0] < regions[1][0]
+    assert regions[2][1] > 1000 and regions[3][1] > 1000 and regions[2][0] < regions[3][0]
+
+
+def test_stacked_receipts_close_together_keep_whole_image(tmp_path):
+    path = tmp_path / "grid.png"
+    write_photo(path, (2400, 1600), [(100, 50, 600, 1120), (900, 50, 600, 1120),
+                                     (100, 1230, 600, 1120), (900, 1230, 600, 1120)])
+    assert segment(path) == [None]
+
+
+def test_undecodable_file_gives_no_ticket(tmp_path):
+    path = tmp_path / ".DS_Store"
+    path.write_bytes(b"\x00\x00\x00\x01Bud1")
+    assert Ticket.segment_image(image_path=path) == []
+
+
+@pytest.fixture
+def ticket_reader(tmp_path, monkeypatch):
+
+    """
+    TicketReader on a temporary ticket directory, without window, Google Sheets nor Tesseract.
+    """
+
+    monkeypatch.setattr(reader.pytesseract, "image_to_string", lambda image, lang: "")
+    ticket_reader = TicketReader.__new__(TicketReader)
+    ticket_reader.ticket_directory = tmp_path
+    ticket_reader.tickets = []
+    ticket_reader.use_gpt = False
+    ticket_reader.sheets = {"Relevé SG": None}
+    ticket_reader.selected_sheet = SimpleNamespace(get=lambda: "Relevé SG")
+    return ticket_reader
+
+
+def test_create_tickets_fans_out_photos(ticket_reader, tmp_path):
+    write_photo(tmp_path / "multi.png", (2000, 2600), [(100, 100, 700, 1700), (950, 100, 700, 1700), (1800, 100, 700, 1700)])
+    write_photo(tmp_path / "single.png", (2000, 1000), [(100, 100, 800, 1800)])
+    (tmp_path / ".DS_Store").write_bytes(b"\x00\x00\x00\x01Bud1")
+
+    ticket_reader.create_tickets()
+
+    tickets = {ticket.file_name: ticket for ticket in ticket_reader.tickets}
+    assert sorted(tickets) == ["multi.png #1", "multi.png #2", "multi.png #3", "single.png"]
+    assert all(tickets[f"multi.png #{index}"].source_file_name == "multi.png" for index in range(1, 4))
+    assert all(tickets[f"multi.png #{index}"].region for index in range(1, 4))
+    assert tickets["single.png"].source_file_name == "single.png"
+    assert tickets["single.png"].region is None
+
+    # Les photos déjà traitées ne donnent pas de nouveaux tickets
+    ticket_reader.create_tickets()
+    assert len(ticket_reader.tickets) == 4
+
+
+def test_get_ticket_image_crops_region(ticket_reader, tmp_path):
+    write_photo(tmp_path / "multi.png", (2000, 2600), [(100, 100, 700, 1700), (950, 100, 700, 1700), (1800, 100, 700, 1700)])
+    write_photo(tmp_path / "single.png", (2000, 1000), [(100, 100, 800, 1800)])
+    ticket_reader.create_tickets()
+
+    for ticket in ticket_reader.tickets:
+        image = ticket_reader.get_ticket_image(ticket=ticket)
+        if ticket.region:
+            assert image.size == (ticket.region[2], ticket.region[3])
+        else:
+            assert image.size == (1000, 2000)